@@ -21,7 +21,7 @@ back with responses:
 
 "GET /client/ws/speech?lang=und&user-agent=RecognizerIntentActivity%2F1.8.14%3B+Google%2Fbarbet%2Flineage_barbet-userdebug+13+TQ1A.230105.001.A2+48648b48b6%3B+null%2Fnull&calling-package=null&user-id=066be6e0-3e5e-4d58-b2e5-fabdd7b549d3&partial=true&content-type=audio%2Fx-raw%2C+layout%3D%28string%29interleaved%2C+rate%3D%28int%2916000%2C+format%3D%28string%29S16LE%2C+channels%3D%28int%291 HTTP/1.1"
 
-what lib can se use to parse that url?
+what lib can se use to parse that url? urllib.parse does it, see on_connect.
 
 client.py is a program in the kaldi-gstreamer github (link: FIXME) that
 is used to test the server.
@@ -31,7 +31,7 @@ when client.py connects, this is written by program (or sublibrary) to stderr:
 when konele connects, this is written by this program (or sublibrary) to stderr:
     192.168.1.144 - - [30/Jan/2023 10:44:37] "GET /client/ws/speech?lang=und&user-agent=RecognizerIntentActivity%2F1.8.14%3B+Google%2Fbarbet%2Flineage_barbet-userdebug+13+TQ1A.230105.001.A2+48648b48b6%3B+null%2Fnull&calling-package=null&user-id=066be6e0-3e5e-4d58-b2e5-fabdd7b549d3&partial=true&content-type=audio%2Fx-raw%2C+layout%3D%28string%29interleaved%2C+rate%3D%28int%2916000%2C+format%3D%28string%29S16LE%2C+channels%3D%28int%291 HTTP/1.1" 101 46
     SO: konele is sending x-raw audio, interleaved, rate 16000, S16LE, channels 1
-    with this rate, the audio will be 8000 samples/second (16 bits per sample)
+    with this rate, the audio will be 16000 samples/second (16 bits per sample), 32KB/s
 
 the audio encoding is present in both, but only konele sends the
 "user-id" info which is presumably sent back by server on each communication?
@@ -39,22 +39,124 @@ the audio encoding is present in both, but only konele sends the
 WHO is writing that URL?
 
 limitations:
-    audio must be 8k samples/second, each sample 16 bits signed, so 16KB/s of data
-    only one request at a time
-    no incremental results yet
-    no authentication on connection
+    raw audio must be mono, each sample 16 bits signed; whisper wants 16k
+    samples/second, other rates (such as 8k telephone audio) are resampled
+    concurrent requests queue for one of num_workers decoders, see transcription_worker
+    incremental results are only sent to clients that ask with partial=true
+    no authentication on connection, but each utterance is capped at MAX_AUDIO_SECONDS
 
 """
 
+import asyncio
+import atexit
+import collections
+import ctypes
+import functools
+import io
+import itertools
 import logging
 import logging.handlers
+import math
 import os
+import queue
 import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+
+def parse_cpu_list(text):
+    """Parse a sysfs cpulist such as "0-7,16-23" into a set of CPU ids."""
+    cpus = set()
+    for part in text.strip().split(","):
+        if part:
+            first, _, last = part.partition("-")
+            cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def pin_cpus():
+    """Pin the process to WHISPER_NUMA_NODE, if set, and size the OpenMP
+    pools to the CPUs it may run on.
+
+    This runs before numpy and CTranslate2 are imported, because OpenMP
+    sizes its thread pool when the first library using it is loaded.
+    """
+    node = os.getenv("WHISPER_NUMA_NODE")
+    if node is not None and hasattr(os, "sched_setaffinity"):
+        # with the threads on one node, first-touch allocation keeps the
+        # weights in that node's memory; numactl --membind makes it strict
+        with open(f"/sys/devices/system/node/node{int(node)}/cpulist") as f:
+            os.sched_setaffinity(0, parse_cpu_list(f.read()))
+    if hasattr(os, "sched_getaffinity"):
+        ncpus = len(os.sched_getaffinity(0))
+    else:
+        ncpus = os.cpu_count() or 1
+    # one OpenMP thread per physical core, assuming two hardware threads each;
+    # more only adds context switches to the memory-bound decoder loop
+    threads = os.getenv("WHISPER_CPU_THREADS", "0")
+    if threads == "0":
+        threads = str(max(ncpus // 2, 1))
+    os.environ.setdefault("OMP_NUM_THREADS", threads)
+    # numpy and scipy are not on the hot path, keep their OpenBLAS single
+    # threaded. MKL_NUM_THREADS is left alone: CTranslate2 links MKL
+    # statically and it would override the thread count CTranslate2 sets
+    os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
+    # keep the OpenMP threads of CTranslate2 (GNU libgomp) on neighbouring
+    # cores instead of letting them migrate
+    os.environ.setdefault("OMP_PROC_BIND", "close")
+    os.environ.setdefault("OMP_PLACES", "cores")
+    return ncpus
+
+
+pinned_cpus = pin_cpus()
 
 import numpy as np
+import orjson
+import websockets
 
 from faster_whisper import WhisperModel
-from wsocket import WSocketApp, WebSocketError, run
+
+try:
+    from faster_whisper import BatchedInferencePipeline
+except ImportError:     # faster-whisper < 1.1
+    BatchedInferencePipeline = None
+
+# numba compiles the PCM conversion loop when it is installed
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# pyahocorasick matches all plain-text corrections in one pass when installed
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# uvloop is a faster drop-in event loop, but it does not build on Windows
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# decoders for compressed uploads, only needed by clients that send them
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+try:
+    import av
+except ImportError:
+    av = None
+
+# only needed for clients that send audio at a rate other than 16 kHz
+try:
+    from scipy import signal
+except ImportError:
+    signal = None
 
 __author__ = "MLops Engineer"
 __version__ = "1.0"
@@ -100,14 +202,25 @@ def setup_logging(level: str = LOG_LEVEL) -> logging.Logger:
     error_handler.setFormatter(formatter)
     error_handler.setLevel(logging.ERROR)
 
+    # the real handlers run on the listener's thread; logging calls on the
+    # event loop only enqueue the record and never wait on disk or rotation
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(
+        log_queue,
+        file_handler,
+        console_handler,
+        error_handler,
+        respect_handler_level=True,
+    )
+    listener.start()
+    atexit.register(listener.stop)
+
     root_logger = logging.getLogger()
     root_logger.setLevel(resolved_level)
     root_logger.handlers.clear()
-    root_logger.addHandler(file_handler)
-    root_logger.addHandler(console_handler)
-    root_logger.addHandler(error_handler)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
 
-    logging.getLogger("wsocket").setLevel(logging.WARNING)
+    logging.getLogger("websockets").setLevel(logging.WARNING)
     logging.getLogger("faster_whisper").setLevel(logging.INFO)
 
     return logging.getLogger("whisper.websocket.server")
@@ -115,83 +228,730 @@ def setup_logging(level: str = LOG_LEVEL) -> logging.Logger:
 
 logger = setup_logging()
 logger.info("Whisper WebSocket Server starting up...")
+logger.info(
+    "CPU setup | cpus=%d | numa_node=%s | omp_threads=%s",
+    pinned_cpus,
+    os.getenv("WHISPER_NUMA_NODE", "<any>"),
+    os.environ["OMP_NUM_THREADS"],
+)
 
 
+# any faster-whisper model name works here, including the distilled
+# CTranslate2 checkpoints ("distil-small.en", "distil-medium.en"), which
+# decode several times faster than the full model at a similar WER
 model_size = os.getenv("WHISPER_MODEL", "base.en")
+# int8 keeps accuracy within noise of float32 while roughly halving the
+# model size; on AVX-512 VNNI hosts CTranslate2 runs the int8 GEMMs on VNNI
+compute_type = os.getenv("WHISPER_COMPUTE_TYPE", "int8")
+num_workers = int(os.getenv("WHISPER_NUM_WORKERS", "1"))
+# split the OpenMP threads between the workers so that num_workers
+# concurrent decodes do not oversubscribe the cores
+cpu_threads = int(os.getenv("WHISPER_CPU_THREADS", "0")) or max(
+    int(os.environ["OMP_NUM_THREADS"]) // max(num_workers, 1), 1
+)
+PORT = int(os.getenv("WHISPER_PORT", "9002"))
+# "ctranslate2" (faster-whisper) or "onnx" for an optimum ONNX Runtime export;
+# measure on the target machine before switching, neither wins everywhere
+BACKEND = os.getenv("WHISPER_BACKEND", "ctranslate2").lower()
+ONNX_MODEL_DIR = os.getenv("WHISPER_ONNX_MODEL_DIR", "onnx_int8")
+ONNX_PROVIDER = os.getenv("WHISPER_ONNX_PROVIDER", "CPUExecutionProvider")
+# number of 30 s windows of one utterance BatchedInferencePipeline runs
+# through the encoder together; only long utterances have more than one
+BATCH_SIZE = int(os.getenv("WHISPER_BATCH_SIZE", "8"))
+# the sample rate whisper models are trained on
+SAMPLE_RATE = 16000
+# clients that ask for partial=true get a hypothesis for the audio so far
+# each time this much new audio has arrived
+PARTIAL_INTERVAL_SECONDS = float(os.getenv("WHISPER_PARTIAL_INTERVAL_SECONDS", "2.0"))
+# longest utterance a client may send; the connection is closed beyond it
+# so a runaway client cannot exhaust memory
+MAX_AUDIO_SECONDS = int(os.getenv("MAX_AUDIO_SECONDS", "300"))
+# audio shorter than this, or with no 30 ms frame above this RMS level (in
+# int16 units), is answered with an empty result without running the model
+MIN_AUDIO_SECONDS = float(os.getenv("WHISPER_MIN_AUDIO_SECONDS", "0.3"))
+SILENCE_RMS = float(os.getenv("WHISPER_SILENCE_RMS", "200"))
+SILENCE_FRAME_SECONDS = 0.03
+# buffers of closed connections kept for reuse, per buffer size
+BUFFER_POOL_SIZE = int(os.getenv("WHISPER_BUFFER_POOL_SIZE", "4"))
+WARMUP = os.getenv("WHISPER_WARMUP", "1") == "1"
 
 # for some reason "tiny" model duplicates recognition output on my test file
 # the "base" model does not have this problem
 
 #logger.setLevel(10)  # for debugging
 
-# RPD: later versions of wsocket want the "client" argument to on_close,
-# but wsocket installed from pip right now does not want that arg
-#def on_close(self, message, client):
-def on_close(self, message):
-    logger.info("Connection closed | message=%s", message)
+# a new connection takes the buffers of a closed one instead of allocating
+# its own: their pages are already mapped in, so there is no fresh mmap and
+# page faulting for every utterance, and no munmap when it ends. Everything
+# runs on the event loop, so no lock is needed
+buffer_pool = collections.defaultdict(list)
+
+def take_buffers(max_bytes):
+    free = buffer_pool[max_bytes]
+    if free:
+        return free.pop()
+    return np.empty(max_bytes, dtype=np.uint8), np.empty(max_bytes // 2, dtype=np.float32)
+
+def release_buffers(client):
+    # a partial still running on a view of these only has its result dropped
+    free = buffer_pool[client.max_bytes]
+    if len(free) < BUFFER_POOL_SIZE:
+        free.append((client.abuf, client.samples))
+
+def on_close(client):
+    logger.info("Connection closed | client=%s", client.remote_address)
+    # nobody is left to receive a partial that has not started yet
+    if client.partial_task is not None:
+        client.partial_task.cancel()
+    release_buffers(client)
+
+def on_connect(client, path):
+    logger.info("Client connected | client=%s | path=%s", client.remote_address, path)
+    client.abuf_segments = 0
+    params = parse_qs(urlsplit(path).query)
+    # Konele sends a user-id that it expects back in every response
+    client.session_id = params.get("user-id", [None])[0] or str(uuid.uuid4())
+    mime, caps = parse_content_type(params.get("content-type", ["audio/x-raw"])[0])
+    client.codec = audio_codec(mime, caps)
+    try:
+        client.rate = int(caps.get("rate", SAMPLE_RATE))
+    except ValueError:
+        client.rate = 0
+    if not 8000 <= client.rate <= 48000:
+        logger.warning("Unusable sample rate, assuming %d | rate=%s", SAMPLE_RATE, caps.get("rate"))
+        client.rate = SAMPLE_RATE
+    logger.info(
+        "Client audio format | content_type=%s | codec=%s | rate=%d",
+        mime,
+        client.codec,
+        client.rate,
+    )
+    # a compressed stream cannot be decoded until it is complete, so
+    # partial results are only offered for raw PCM
+    client.partial = params.get("partial", ["false"])[0] == "true" and client.codec == "raw"
+    # both buffers are allocated at their final size up front, so audio is
+    # written in place and never copied to grow them. np.empty only reserves
+    # address space, pages are touched as audio fills them; bytearray(n)
+    # would zero the whole 9.6 MB for every connection
+    client.max_bytes = MAX_AUDIO_SECONDS * client.rate * 2
+    client.abuf, client.samples = take_buffers(client.max_bytes)
+    client.abuf_pos = 0             # bytes of abuf received so far
+    client.nsamples = 0             # samples of abuf already converted
+    client.partial_bytes = 0        # abuf_pos when the last partial was started
+    client.partial_interval_bytes = int(PARTIAL_INTERVAL_SECONDS * client.rate * 2)
+    client.partial_task = None
+    client.finished = False
+
+OnnxSegment = collections.namedtuple("OnnxSegment", "text")
+
+
+class OnnxWhisperModel:
+    """Whisper exported with optimum and run on ONNX Runtime.
+
+    Only provides the part of faster-whisper's transcribe() this server
+    uses: segments with a .text, one per 30 s window. faster-whisper options
+    such as vad_filter have no equivalent here and are ignored.
+    """
+
+    def __init__(self, model_dir, provider):
+        # imported here, they pull in torch and are only needed for this backend
+        from optimum.onnxruntime import ORTModelForSpeechSeq2Seq
+        from transformers import WhisperProcessor
+
+        self.processor = WhisperProcessor.from_pretrained(model_dir)
+        self.model = ORTModelForSpeechSeq2Seq.from_pretrained(model_dir, provider=provider)
+        self.window = 30 * SAMPLE_RATE
+
+    def transcribe(self, audio, **options):
+        segments = (
+            self.decode_window(audio[start:start + self.window])
+            for start in range(0, audio.shape[0], self.window)
+        )
+        return segments, None
+
+    def decode_window(self, audio):
+        features = self.processor(audio, sampling_rate=SAMPLE_RATE, return_tensors="pt").input_features
+        tokens = self.model.generate(features)
+        return OnnxSegment(self.processor.batch_decode(tokens, skip_special_tokens=True)[0])
+
+
+if BACKEND == "onnx":
+    logger.info("Loading ONNX Whisper model | dir=%s | provider=%s", ONNX_MODEL_DIR, ONNX_PROVIDER)
+    model = OnnxWhisperModel(ONNX_MODEL_DIR, ONNX_PROVIDER)
+    pipeline = model
+    transcribe_options = {}
+else:
+    logger.info(
+        "Loading Whisper model | model=%s | compute_type=%s | cpu_threads=%d | num_workers=%d",
+        model_size,
+        compute_type,
+        cpu_threads,
+        num_workers,
+    )
+    model = WhisperModel(
+        model_size,
+        device="cpu",
+        compute_type=compute_type,
+        cpu_threads=cpu_threads,
+        num_workers=num_workers,
+    )
+
+    # faster-whisper cannot batch separate utterances through one decode, but
+    # BatchedInferencePipeline batches the encoder passes over the 30 s windows
+    # of each utterance, and num_workers utterances are decoded side by side
+    if BatchedInferencePipeline is not None:
+        pipeline = BatchedInferencePipeline(model=model)
+        transcribe_options = {"batch_size": BATCH_SIZE}
+    else:
+        pipeline = model
+        # WhisperModel.transcribe only splits on 2 s pauses; 500 ms trims far
+        # more of a typical utterance. BatchedInferencePipeline already
+        # defaults to 160 ms, so it keeps its own setting
+        transcribe_options = {"vad_parameters": {"min_silence_duration_ms": 500}}
+    # silero VAD drops the silence between phrases, which also keeps the
+    # repeated partial transcriptions of a growing buffer cheap
+    transcribe_options["vad_filter"] = True
+
+def warm_up():
+    """Transcribe a second of silence so the first client does not pay for
+    paging in the weights and setting up the kernels."""
+    silence = np.zeros(SAMPLE_RATE, dtype=np.float32)
+    started = time.monotonic()
+    # with vad_filter the silence would be dropped before reaching the model
+    segments, _ = model.transcribe(silence, vad_filter=False)
+    for _ in segments:
+        pass
+    # and this loads the VAD model, if the backend has one
+    segments, _ = pipeline.transcribe(silence, **transcribe_options)
+    for _ in segments:
+        pass
+    logger.info("Model warm-up done | seconds=%.2f", time.monotonic() - started)
+
+if WARMUP:
+    warm_up()
+
+# created by main(), so it belongs to the running event loop
+transcription_queue = None
 
-# does this override the on_connect in wsocket? or in addition to that (+=)?
-def on_connect(client):
-    logger.info("Client connected | client=%s | path=%s", repr(client), getattr(client, "path", "<unknown>"))
-    client.abuf = []  # list of binary data segments that will be joined
 
-model = WhisperModel(model_size, device="cpu", compute_type="int8")
+def transcribe(audio_np, on_text=None):
+    """Transcribe audio_np, calling on_text with the text so far after each
+    segment is decoded, if given."""
+    segments, _ = pipeline.transcribe(audio_np, **transcribe_options)
+    # BatchedInferencePipeline yields nothing until it has decoded a whole
+    # batch of 30 s windows, all of a typical utterance, so its segments
+    # would only arrive in a burst right before the final result
+    if on_text is None or pipeline is not model:
+        return " ".join(segment.text.strip() for segment in segments)
+    rr=[]
+    for segment in segments:
+        rr.append(segment.text.strip())
+        on_text(" ".join(rr))
+    return " ".join(rr)
+
+
+async def run_request(loop, executor, request, slots):
+    _, _, audio_np, future, on_text = request
+    try:
+        # CTranslate2 releases the GIL, so the event loop keeps serving
+        # other clients while this runs
+        text = await loop.run_in_executor(executor, transcribe, audio_np, on_text)
+    except Exception as exc:
+        if not future.done():
+            future.set_exception(exc)
+        return
+    finally:
+        slots.release()
+    if not future.done():
+        future.set_result(text)
+
+
+async def transcription_worker():
+    loop = asyncio.get_running_loop()
+    workers = max(num_workers, 1)
+    # one slot per decoder: a request is taken off the queue as soon as a
+    # decoder is free and runs without waiting for any other request
+    slots = asyncio.Semaphore(workers)
+    running = set()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="transcribe") as executor:
+        while True:
+            await slots.acquire()
+            request = await transcription_queue.get()
+            # partials superseded by their client's EOS are dropped here
+            if request[3].cancelled():
+                slots.release()
+                continue
+            task = asyncio.create_task(run_request(loop, executor, request, slots))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+
+# a client waiting on its final result goes ahead of any queued partial;
+# within a priority, requests run in the order they were submitted
+FINAL_PRIORITY = 0
+PARTIAL_PRIORITY = 1
+request_counter = itertools.count()
+
+
+def submit_transcription(audio_np, on_text=None, priority=FINAL_PRIORITY):
+    future = asyncio.get_running_loop().create_future()
+    transcription_queue.put_nowait((priority, next(request_counter), audio_np, future, on_text))
+    return future
+
 
 # always make the following user-specific corrections
 # for example, 99% of the time when I say Conor Drewes I am referring to
 # my son Conor Drewes not Connor Drews!
+# each (pattern, replacement) pair is applied in list order to the output of
+# the ones before it, e.g. [("Connor", "Conor"), ("Conor Drews", "Conor Drewes")]
 corrections=[
         
         ]
 
-def on_message(message, client):
-    #print(repr(client) + " : " + repr(message))
-    # messages with class 'bytearray' becomes class 'str' for EOS message
-    #print(type(message))
+# compiled once here rather than re-parsed by re.sub on every request.
+# [^\]]* instead of .* keeps the bracket scan linear and stops it from
+# swallowing the text between two separate [...] annotations
+BRACKET_RE = re.compile(r"\[[^\]]*\]")
+
+# corrections that are plain text on both sides are replaced in a single
+# scan of the transcript, instead of one re.sub pass each. A plain-text entry
+# only joins the scan of the entries just before it if it cannot match their
+# text or their replacements, so the result is the same as applying the list
+# one entry at a time; anything using regex syntax gets its own re.sub
+REGEX_METACHARS = set(".^$*+?{}[]\\|()")
+
+
+def is_literal_correction(a, b):
+    return a and not REGEX_METACHARS.intersection(a) and "\\" not in b
+
+
+def texts_overlap(x, y):
+    """True if x and y can match overlapping text: one contains the other,
+    or one ends with the start of the other."""
+    if x in y or y in x:
+        return True
+    return any(x.endswith(y[:i]) or y.endswith(x[:i]) for i in range(1, min(len(x), len(y))))
+
+
+def apply_automaton(automaton, m):
+    parts=[]
+    pos=0
+    # leftmost-longest, non-overlapping matches, reported by end index
+    for end, (length, replacement) in automaton.iter_long(m):
+        parts.append(m[pos:end - length + 1])
+        parts.append(replacement)
+        pos=end + 1
+    if not parts:
+        return m
+    parts.append(m[pos:])
+    return "".join(parts)
+
+
+def literal_pass(table):
+    """Return a function that replaces every key of table in one scan."""
+    if ahocorasick is None:
+        # fallback for when pyahocorasick is missing: one alternation, longest
+        # first so it prefers the same matches as the automaton
+        pattern = re.compile("|".join(re.escape(a) for a in sorted(table, key=len, reverse=True)))
+        return functools.partial(pattern.sub, lambda match: table[match.group(0)])
+    automaton = ahocorasick.Automaton()
+    for a, b in table.items():
+        automaton.add_word(a, (len(a), b))
+    automaton.make_automaton()
+    return functools.partial(apply_automaton, automaton)
+
+
+def build_corrections(corrections):
+    """Compile corrections into a list of functions to apply in order."""
+    groups = []
+    for a, b in corrections:
+        if not is_literal_correction(a, b):
+            groups.append((re.compile(a), b))
+            continue
+        group = groups[-1] if groups and isinstance(groups[-1], dict) else None
+        if group is None or any(texts_overlap(a, text) for pair in group.items() for text in pair):
+            group = {}
+            groups.append(group)
+        group[a] = b
+    return [
+        literal_pass(group) if isinstance(group, dict) else functools.partial(group[0].sub, group[1])
+        for group in groups
+    ]
+
+CORRECTIONS = build_corrections(corrections)
+
+# "(int)16000" -> "16000" in gstreamer caps fields
+CAPS_TYPE_RE = re.compile(r"^\([a-z]+\)")
+
+PCM16_SCALE = np.float32(1.0 / 32768.0)
+
+if numba is not None:
+    @numba.njit(cache=True, fastmath=True, boundscheck=False)
+    def pcm16_to_float32_kernel(src, dst):
+        # LLVM vectorizes this into a sign-extend, convert, multiply loop
+        # with no temporary, which beats the np.multiply casting loop by
+        # 2-4x from a few hundred samples up, and has far less call overhead
+        scale = np.float32(1.0 / 32768.0)
+        for i in range(src.shape[0]):
+            dst[i] = src[i] * scale
+
+    # compile (or load from cache) now rather than on the first client's audio
+    pcm16_to_float32_kernel(np.zeros(1024, dtype=np.int16), np.empty(1024, dtype=np.float32))
+else:
+    pcm16_to_float32_kernel = None
+
+# the AVX2/AVX-512 kernel from pcm_i16_to_f32.c, if it has been built next to
+# this script. ctypes costs a few microseconds a call, more than converting a
+# whole Konele chunk, so it only takes buffers of at least this many samples
+NATIVE_KERNEL_MIN_SAMPLES = 1 << 16
+NATIVE_KERNEL_NAMES = ("libpcm_i16_to_f32.so", "libpcm_i16_to_f32.dylib", "pcm_i16_to_f32.dll")
+
+
+def load_native_kernel():
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in NATIVE_KERNEL_NAMES:
+        path = os.path.join(here, name)
+        if not os.path.exists(path):
+            continue
+        try:
+            kernel = ctypes.CDLL(path).pcm_i16_to_f32
+        except (OSError, AttributeError):
+            logger.warning("Could not load native PCM kernel | path=%s", path, exc_info=True)
+            continue
+        kernel.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+        kernel.restype = None
+        logger.info("Using native PCM kernel | path=%s", path)
+        return kernel
+    return None
+
+native_pcm16_to_float32 = load_native_kernel()
+
+if signal is not None:
+    # the windowed-sinc lowpass resample_poly would design for up=2, built
+    # once here so 8 kHz input goes straight to upfirdn's C loop. FFT based
+    # signal.resample is no good for speech: it assumes a periodic signal
+    UPSAMPLE_2X_TAPS = (signal.firwin(41, 0.5, window=("kaiser", 5.0)) * 2).astype(np.float32)
+
+
+def pcm16_to_float32(data, out=None):
+    """Convert S16LE bytes to float32 samples in [-1, 1).
+
+    The cast and the scale are done in one pass into a preallocated output,
+    by the native kernel for large buffers, else numba or a single ufunc.
+    """
+    samples = np.frombuffer(data, dtype=np.int16, count=memoryview(data).nbytes // 2)
+    if out is None:
+        out = np.empty(samples.shape[0], dtype=np.float32)
+    if native_pcm16_to_float32 is not None and samples.shape[0] >= NATIVE_KERNEL_MIN_SAMPLES:
+        native_pcm16_to_float32(samples.ctypes.data, out.ctypes.data, samples.shape[0])
+    elif pcm16_to_float32_kernel is not None:
+        pcm16_to_float32_kernel(samples, out)
+    else:
+        np.multiply(samples, PCM16_SCALE, out=out, casting="unsafe")
+    return out
+
+def append_samples(client):
+    """Convert the complete samples added to client.abuf since the last call."""
+    total = client.abuf_pos // 2
+    if total <= client.nsamples:
+        return
+    pcm16_to_float32(
+        client.abuf[client.nsamples * 2:total * 2],
+        out=client.samples[client.nsamples:total],
+    )
+    client.nsamples = total
+
+def parse_content_type(value):
+    """Split a gstreamer caps string such as the one Konele sends.
+
+    "audio/x-raw, rate=(int)16000, format=(string)S16LE" gives
+    ("audio/x-raw", {"rate": "16000", "format": "S16LE"}).
+    """
+    mime, *fields = [part.strip() for part in value.split(",")]
+    caps = {}
+    for field in fields:
+        key, _, val = field.partition("=")
+        caps[key.strip()] = CAPS_TYPE_RE.sub("", val.strip())
+    return mime.lower(), caps
+
+def audio_codec(mime, caps):
+    fmt = caps.get("format", "").lower()
+    if "flac" in mime or fmt == "flac":
+        return "flac"
+    if "opus" in mime or "ogg" in mime or "webm" in mime or fmt == "opus":
+        return "opus"
+    return "raw"
+
+class AudioTooLong(ValueError):
+    """Decoded audio is longer than MAX_AUDIO_SECONDS."""
+
+# the byte budget in on_audio counts encoded bytes, and an hour of FLAC
+# silence is only a few hundred KB, so the decoders enforce the limit on
+# the decoded length too, stopping before they have decoded more than that
+def decode_flac(data):
+    if soundfile is None:
+        raise RuntimeError("FLAC audio needs the soundfile package")
+    with soundfile.SoundFile(io.BytesIO(data)) as f:
+        rate = f.samplerate
+        max_frames = MAX_AUDIO_SECONDS * rate
+        samples = f.read(max_frames + 1, dtype="int16", always_2d=True)
+    if samples.shape[0] > max_frames:
+        raise AudioTooLong(f"FLAC audio longer than {MAX_AUDIO_SECONDS} s")
+    return np.ascontiguousarray(samples[:, 0]), rate
+
+def decode_opus(data):
+    if av is None:
+        raise RuntimeError("Opus audio needs the av package")
+    # let libav convert to what whisper wants, whatever the encoder used
+    resampler = av.AudioResampler(format="s16", layout="mono", rate=SAMPLE_RATE)
+    max_samples = MAX_AUDIO_SECONDS * SAMPLE_RATE
+    chunks = []
+    total = 0
+    with av.open(io.BytesIO(data)) as container:
+        for frame in container.decode(audio=0):
+            for resampled in resampler.resample(frame):
+                chunks.append(resampled.to_ndarray().reshape(-1))
+                total += chunks[-1].shape[0]
+            if total > max_samples:
+                raise AudioTooLong(f"Opus audio longer than {MAX_AUDIO_SECONDS} s")
+    for resampled in resampler.resample(None):
+        chunks.append(resampled.to_ndarray().reshape(-1))
+    if not chunks:
+        return np.empty(0, dtype=np.int16)
+    return np.concatenate(chunks)
+
+def to_model_rate(audio, rate):
+    """Resample float32 audio recorded at rate to the 16 kHz whisper expects."""
+    if rate == SAMPLE_RATE:
+        return audio
+    if signal is None:
+        raise RuntimeError(f"{rate} Hz audio needs scipy for resampling")
+    if rate * 2 == SAMPLE_RATE:
+        # drop the filter delay the same way resample_poly does
+        delay = (UPSAMPLE_2X_TAPS.shape[0] - 1) // 2
+        return signal.upfirdn(UPSAMPLE_2X_TAPS, audio, up=2)[delay:delay + 2 * audio.shape[0]]
+    divisor = math.gcd(SAMPLE_RATE, rate)
+    return signal.resample_poly(audio, SAMPLE_RATE // divisor, rate // divisor).astype(np.float32, copy=False)
+
+def client_samples_out(client, samples):
+    # compressed streams leave client.samples unused, so decoded audio is
+    # converted into it instead of a fresh array when it fits
+    if samples.shape[0] <= client.samples.shape[0]:
+        return client.samples[:samples.shape[0]]
+    return None
+
+def decode_audio(client):
+    """Return the client's audio so far as 16 kHz float32 samples for whisper."""
+    if client.codec == "flac":
+        samples, rate = decode_flac(client.abuf[:client.abuf_pos])
+        return to_model_rate(pcm16_to_float32(samples, out=client_samples_out(client, samples)), rate)
+    if client.codec == "opus":
+        samples = decode_opus(client.abuf[:client.abuf_pos])
+        return pcm16_to_float32(samples, out=client_samples_out(client, samples))
+    return to_model_rate(client.samples[:client.nsamples], client.rate)
+
+def clean_transcript(m):
+    logger.debug("Recognition result before strip: %s", m)
+    m=m.strip()
+    # sometimes whisper puts in commentary like [soft music] and we strip that out:
+    logger.debug("Recognition result before bracket regex: %s", m)
+    m=BRACKET_RE.sub("", m)
+    logger.debug("Recognition result after bracket regex: %s", m)
+    for correct in CORRECTIONS:
+        m=correct(m)
+    logger.debug("Recognition result after local corrections: %s", m)
+    return m
+
+def result_message(client, m, final):
+    # a real JSON encoder, so quotes and backslashes in m are escaped properly
+    return orjson.dumps({
+        "status": 0,
+        "segment": 0,
+        "result": {"hypotheses": [{"transcript": m}], "final": final},
+        "id": client.session_id,
+    }).decode()
+
+def is_silent(audio, rate=SAMPLE_RATE):
+    """True if audio is too short or too quiet to hold speech.
+
+    Whisper still runs a full encoder pass on such input, and tends to
+    hallucinate "you" or "Thank you." from it.
+    """
+    if audio.shape[0] == 0 or audio.shape[0] < MIN_AUDIO_SECONDS * rate:
+        return True
+    # judge the loudest 30 ms frame, not the whole buffer: a short word in a
+    # long, otherwise quiet recording barely moves the overall RMS
+    frame = min(max(int(rate * SILENCE_FRAME_SECONDS), 1), audio.shape[0])
+    frames = audio[:audio.shape[0] // frame * frame].reshape(-1, frame)
+    # einsum sums the squares of each frame without a squared temporary
+    mean_square = float(np.einsum("ij,ij->i", frames, frames).max()) / frames.shape[1]
+    return mean_square < (SILENCE_RMS / 32768.0) ** 2
+
+def error_message(client, message):
+    # status 2 is kaldi-gstreamer's "aborted"
+    return orjson.dumps({"status": 2, "message": message, "id": client.session_id}).decode()
+
+def prepare_partial(audio, rate):
+    """Model input for a partial result, or None if the audio is silent."""
+    if is_silent(audio, rate):
+        return None
+    return to_model_rate(audio, rate)
+
+def start_partial(client):
+    # new audio is only ever written past nsamples, so this view stays
+    # valid while the transcription runs
+    client.partial_bytes = client.abuf_pos
+    audio = client.samples[:client.nsamples]
+    client.partial_task = asyncio.create_task(send_partial(client, audio))
+
+async def send_partial(client, audio):
     try:
-        if isinstance(message, str):        # "EOS" message
-            # what if this takes so long the client gives up? should send incremental results,
-            # or a least pretend results, while we process
-            audio_data = b"".join(client.abuf)
-            logger.info(
-                "Received final audio buffer | segments=%d | bytes=%d",
-                len(client.abuf),
-                len(audio_data),
-            )
-            audio_np=np.frombuffer(audio_data, dtype=np.int16).astype(np.float32) / 32768.0
-            segments, _ = model.transcribe(audio_np)
-            rr=[]
-            for segment in segments:
-                rr.append(segment.text)
-            m=" ".join(rr)
-            logger.debug("Recognition result before strip: %s", m)
-            m=m.strip()
-            # sometimes whisper puts in commentary like [soft music] and we strip that out:
-            logger.debug("Recognition result before bracket regex: %s", m)
-            m=re.sub(r"\[.*\]", "", m)
-            logger.debug("Recognition result after bracket regex: %s", m)
-            # was having problems with things like "He said hello" which became He said, "Hello"
-            m=re.sub(r'"', '\\"', m)          # convert " to \\"
-            logger.debug("Recognition result after quoting: %s", m)
-            for a, b in corrections:
-                m=re.sub(a, b, m)
-            logger.debug("Recognition result after local corrections: %s", m)
-            # send json result to konele client:
-            msg=f'{{"status": 0, "segment": 0, "result": {{"hypotheses": [{{"transcript": "{m}"}}], "final": true}}, "id": "1aacc69d-3674-438a-b3c5-fc0ed51769a5"}}'
-            logger.info("Sending transcription result | length=%d", len(msg))
-            client.send(msg)
-            client.close()
-        else:   # hopefully message is <class 'bytearray'>, and we just accummulate audio data
-            client.abuf.append(message)
-            logger.debug("Audio buffer segment added | total_segments=%d", len(client.abuf))
-
-    except WebSocketError:
-        logger.warning("WebSocketError while processing message", exc_info=True)
-        pass
-
-app = WSocketApp()
-app.onconnect += on_connect
-app.onmessage += on_message
-app.onclose += on_close
-
-run(app, host="0.0.0.0", port=9002)
+        # the whole buffer so far is resampled for every partial, tens of ms
+        # for a long utterance, so keep it off the event loop
+        audio_np = await asyncio.get_running_loop().run_in_executor(
+            None, prepare_partial, audio, client.rate
+        )
+        if audio_np is None:
+            return
+        m=clean_transcript(await submit_transcription(audio_np, priority=PARTIAL_PRIORITY))
+    except asyncio.CancelledError:
+        return
+    except Exception:
+        logger.warning("Partial transcription failed", exc_info=True)
+        return
+    finally:
+        client.partial_task = None
+    # never send a partial after the final result
+    if client.finished or not m:
+        return
+    await send_quietly(client, result_message(client, m, final=False))
+
+async def send_quietly(client, msg):
+    try:
+        await client.send(msg)
+    except websockets.ConnectionClosed:
+        logger.debug("Connection closed before partial result was sent")
+
+def segment_streamer(client):
+    """Return an on_text callback that sends each segment of the final
+    transcription as a partial result as soon as it is decoded, so the
+    first words show up before the whole utterance is done. Only the
+    non-batched backends call it, see transcribe."""
+    loop = asyncio.get_running_loop()
+
+    def on_text(m):
+        # runs on the transcription thread; the sends are scheduled on the
+        # loop in order, and all before the final result resolves
+        msg = result_message(client, clean_transcript(m), final=False)
+        asyncio.run_coroutine_threadsafe(send_quietly(client, msg), loop)
+
+    return on_text
+
+async def on_eos(client):
+    logger.info(
+        "Received final audio buffer | segments=%d | bytes=%d",
+        client.abuf_segments,
+        client.abuf_pos,
+    )
+    # a partial still waiting in the queue is superseded by this one
+    pending = client.partial_task
+    if pending is not None:
+        pending.cancel()
+    client.finished = True
+    try:
+        # decoding FLAC/Opus is real work, keep it off the event loop
+        audio_np = await asyncio.get_running_loop().run_in_executor(None, decode_audio, client)
+    except AudioTooLong:
+        logger.warning(
+            "Audio limit exceeded after decoding | client=%s | max_seconds=%d",
+            client.remote_address,
+            MAX_AUDIO_SECONDS,
+        )
+        await client.send(error_message(client, "audio too long"))
+        return
+    except Exception:
+        logger.exception("Could not decode audio | codec=%s", client.codec)
+        await client.send(error_message(client, "could not decode audio"))
+        return
+    if is_silent(audio_np):
+        logger.info("Skipping transcription of silent audio | samples=%d", audio_np.shape[0])
+        m=""
+    else:
+        on_text = segment_streamer(client) if client.partial else None
+        try:
+            m=clean_transcript(await submit_transcription(audio_np, on_text))
+        except Exception:
+            logger.exception("Transcription failed | samples=%d", audio_np.shape[0])
+            await client.send(error_message(client, "transcription failed"))
+            return
+    # send json result to konele client:
+    msg=result_message(client, m, final=True)
+    logger.info("Sending transcription result | length=%d", len(msg))
+    await client.send(msg)
+
+def on_audio(client, message):
+    """Store a chunk of audio; returns False if it does not fit."""
+    end = client.abuf_pos + len(message)
+    if end > client.max_bytes:
+        logger.warning(
+            "Audio limit exceeded, closing | client=%s | max_seconds=%d",
+            client.remote_address,
+            MAX_AUDIO_SECONDS,
+        )
+        return False
+    client.abuf[client.abuf_pos:end] = np.frombuffer(message, dtype=np.uint8)
+    client.abuf_pos = end
+    client.abuf_segments += 1
+    if client.codec == "raw":
+        append_samples(client)
+    # runs for every chunk, skip building the log record unless it is wanted
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Audio buffer segment added | total_segments=%d | bytes=%d",
+            client.abuf_segments,
+            client.abuf_pos,
+        )
+    # at most one partial in flight per client, so a slow
+    # decode never queues up a backlog of stale hypotheses
+    if (
+        client.partial
+        and client.partial_task is None
+        and client.abuf_pos - client.partial_bytes >= client.partial_interval_bytes
+    ):
+        start_partial(client)
+    return True
+
+def request_path(client):
+    # websockets >= 13 exposes the handshake request, older versions the path
+    request = getattr(client, "request", None)
+    if request is not None:
+        return request.path
+    return getattr(client, "path", "")
+
+async def handler(client):
+    on_connect(client, request_path(client))
+    try:
+        async for message in client:
+            if isinstance(message, str):        # "EOS" message
+                await on_eos(client)
+                break
+            if not on_audio(client, message):   # binary frame, more audio
+                await client.send(error_message(client, "audio too long"))
+                break
+    except websockets.ConnectionClosed:
+        logger.warning("Connection closed before EOS | client=%s", client.remote_address)
+    finally:
+        on_close(client)
+
+async def main():
+    global transcription_queue
+    transcription_queue = asyncio.PriorityQueue()
+    worker = asyncio.create_task(transcription_worker())
+    # permessage-deflate roughly halves raw PCM uploads on slow links
+    async with websockets.serve(handler, "0.0.0.0", PORT, compression="deflate"):
+        await worker
+
+if uvloop is not None:
+    uvloop.run(main())
+else:
+    asyncio.run(main())
@@ -0,0 +1,84 @@
+/*
+ * S16LE -> float32 conversion for minimal-fw-mem.py, loaded with ctypes.
+ *
+ * Build next to the script:
+ *
+ *   gcc -O3 -shared -fPIC -o libpcm_i16_to_f32.so pcm_i16_to_f32.c
+ *
+ * The AVX2 and AVX-512 loops are compiled with target attributes and picked
+ * at runtime, so one build runs on any x86-64 host without -march=native.
+ * Other CPUs get the scalar loop, which the compiler vectorizes for the
+ * baseline ISA.
+ */
+#include <stddef.h>
+#include <stdint.h>
+
+#if defined(__x86_64__) || defined(__i386__)
+#include <immintrin.h>
+#define HAVE_X86 1
+#endif
+
+#ifdef _WIN32
+#define EXPORT __declspec(dllexport)
+#else
+#define EXPORT
+#endif
+
+#define SCALE (1.0f / 32768.0f)
+
+static void convert_scalar(const int16_t *src, float *dst, size_t n)
+{
+    for (size_t i = 0; i < n; i++)
+        dst[i] = (float)src[i] * SCALE;
+}
+
+#ifdef HAVE_X86
+__attribute__((target("avx2")))
+static void convert_avx2(const int16_t *src, float *dst, size_t n)
+{
+    const __m256 scale = _mm256_set1_ps(SCALE);
+    size_t i = 0;
+
+    /* 16 samples a step: one 256-bit load, each half widened to 8 x int32 */
+    for (; i + 16 <= n; i += 16) {
+        _mm_prefetch((const char *)(src + i + 64), _MM_HINT_T0);
+        __m256i s16 = _mm256_loadu_si256((const __m256i *)(src + i));
+        __m256i lo = _mm256_cvtepi16_epi32(_mm256_castsi256_si128(s16));
+        __m256i hi = _mm256_cvtepi16_epi32(_mm256_extracti128_si256(s16, 1));
+        _mm256_storeu_ps(dst + i, _mm256_mul_ps(_mm256_cvtepi32_ps(lo), scale));
+        _mm256_storeu_ps(dst + i + 8, _mm256_mul_ps(_mm256_cvtepi32_ps(hi), scale));
+    }
+    convert_scalar(src + i, dst + i, n - i);
+}
+
+__attribute__((target("avx512f")))
+static void convert_avx512(const int16_t *src, float *dst, size_t n)
+{
+    const __m512 scale = _mm512_set1_ps(SCALE);
+    size_t i = 0;
+
+    /* 16 samples a step, widened straight to one 512-bit register */
+    for (; i + 16 <= n; i += 16) {
+        _mm_prefetch((const char *)(src + i + 64), _MM_HINT_T0);
+        __m256i s16 = _mm256_loadu_si256((const __m256i *)(src + i));
+        __m512 f = _mm512_cvtepi32_ps(_mm512_cvtepi16_epi32(s16));
+        _mm512_storeu_ps(dst + i, _mm512_mul_ps(f, scale));
+    }
+    convert_scalar(src + i, dst + i, n - i);
+}
+#endif
+
+EXPORT void pcm_i16_to_f32(const int16_t *src, float *dst, size_t n)
+{
+#ifdef HAVE_X86
+    if (__builtin_cpu_supports("avx512f")) {
+        convert_avx512(src, dst, n);
+        return;
+    }
+    if (__builtin_cpu_supports("avx2")) {
+        convert_avx2(src, dst, n);
+        return;
+    }
+#endif
+    convert_scalar(src, dst, n);
+}